@@ -1,217 +1,366 @@
 import os
-from typing import List
-import toml
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import byref, c_float, c_uint, c_ushort
+from typing import Dict, List
 import numpy as np
 
-from pycaenhv.wrappers import init_system, deinit_system, get_board_parameters, get_crate_map, get_channel_parameter, set_channel_parameter, get_channel_parameter_property
+from pycaenhv.wrappers import init_system, deinit_system, get_board_parameters, get_crate_map, get_channel_parameter, get_channel_parameter_property
 from pycaenhv.helpers import channel_info
-from pycaenhv.enums import CAENHV_SYSTEM_TYPE, LinkType
-from pycaenhv.errors import CAENHVError
+from pycaenhv.enums import CAENHV_SYSTEM_TYPE, LinkType, ParamType
+from pycaenhv.errors import CAENHVError, check_function_output
+from pycaenhv.functions import CAENHV_GetChParam, CAENHV_SetChParam
 from pycaenhv.module import CaenHVModule
 
-MESSAGES = {
-    (0, 1): 'The board {daq} is in power-fail status',
-    (1, 2): 'The board {daq} is in power-fail status',
-    (2, 1): 'The board {daq} has a calibration error on HV',
-    (3, 1): 'The board {daq} has a calibration error on temperature',
-    (4, 1): 'The board {daq} is in under-temperature status',
-    (5, 1): 'The board {daq} is in over-temperature status'
-}
+# Status messages indexed by bit: (expected_value, template)
+_STATUS = (
+    (1, 'The board {daq} is in power-fail status'),
+    (2, 'The board {daq} is in power-fail status'),
+    (1, 'The board {daq} has a calibration error on HV'),
+    (1, 'The board {daq} has a calibration error on temperature'),
+    (1, 'The board {daq} is in under-temperature status'),
+    (1, 'The board {daq} is in over-temperature status'),
+)
 
 
 def _check_status(parameter_value: List[int], daq):
     """Decode status."""
-    compteur = 0
-    for el in parameter_value:
-        msg = MESSAGES.get((compteur, el), None)
-        if msg:
-            print(msg.format(daq=daq))
-        compteur += 1
+    for (expected, template), el in zip(_STATUS, parameter_value):
+        if el == expected:
+            print(template.format(daq=daq))
+
+
+# ctypes type of each parameter per (handle, board, param), the Type is static firmware metadata
+_value_types: Dict = {}
+
+
+def _value_type(handle: int, board: int, channel: int, param: str):
+    """ctypes type of the values of a channel parameter, from its Type property."""
+    key = (handle, board, param)
+    value_type = _value_types.get(key)
+    if value_type is None:
+        param_type = get_channel_parameter_property(handle, board, channel,
+                                                    param, 'Type')
+        if ParamType(param_type) == ParamType.NUMERIC:
+            value_type = c_float
+        else:
+            value_type = c_uint
+        _value_types[key] = value_type
+    return value_type
+
+
+def set_channel_parameter_list(handle: int, board: int, channels: List[int],
+                               param: str, values: List):
+    """
+    Set a parameter on several channels of the same board.
+    CAENHV_SetChParam applies one value to a list of channels, so channels are grouped by value and one library call is done per distinct value.
+    """
+    value_type = _value_type(handle, board, channels[0], param)
+    by_value: Dict = {}
+    for channel, value in zip(channels, values):
+        by_value.setdefault(value, []).append(channel)
+    for value, chans in by_value.items():
+        ch_list = (c_ushort * len(chans))(*chans)
+        c_value = value_type(value)
+        res = CAENHV_SetChParam(handle, board, param.encode(), len(chans),
+                                ch_list, byref(c_value))
+        check_function_output(res)
+
+
+def _get_channel_parameter_multi(handle: int, board: int, channels: List[int],
+                                 param: str) -> List:
+    """
+    Read a parameter from several channels of the same board in one library call.
+    Returns the values in the order of channels.
+    """
+    value_type = _value_type(handle, board, channels[0], param)
+    ch_list = (c_ushort * len(channels))(*channels)
+    values = (value_type * len(channels))()
+    res = CAENHV_GetChParam(handle, board, param.encode(), len(channels),
+                            ch_list, values)
+    check_function_output(res)
+    return list(values)
+
+
+# Parameters whose last written value is cached to skip identical writes.
+# Power commands are never skipped, the crate may have changed them (trip, interlock, other client).
+_CACHED_PARAMETERS = ('V0Set', )
+
+
+def _config_value(prop: Dict, default: Dict, key: str, daq: str, mode: str):
+    """Value of key for a DAQ board, falling back on the default section."""
+    if key in prop:
+        return prop[key]
+    if key in default:
+        return default[key]
+    raise ValueError(f"Module {daq} in [{mode}] has no '{key}' and no default")
+
+
+def _open_crate(crate: Dict) -> int:
+    """Connect to the crate described in the config and return its handle."""
+    system_type = CAENHV_SYSTEM_TYPE[crate['module']]
+    link_type = LinkType[crate['linktype']]
+    return init_system(system_type, link_type, crate['address'],
+                       crate['username'], crate['password'])
 
 
 class SndCaenManager():
+    __slots__ = ('config', 'handles', 'crates_maps', '_resolved',
+                 '_daqs_by_mode', '_board_v', '_bias_v0', '_bias_offset',
+                 '_bias_daqs', '_bias_index', '_bias_offsets_arr',
+                 '_unit_cache', '_last_set')
+
     def __init__(self, confPath: str):
+        import toml
         self.config = toml.load(confPath)
-        self.handles = []
+        self._unit_cache = {}
+        self._last_set = {}
+        self._validate_and_resolve_config()
 
-        for crate in self.config['crates']:
-            system_type = CAENHV_SYSTEM_TYPE[crate['module']]
-            link_type = LinkType[crate['linktype']]
-            self.handles.append(
-                init_system(system_type, link_type, crate['address'],
-                            crate['username'], crate['password']))
+        # Crates are opened in parallel, the library releases the GIL while connecting
+        crates = self.config['crates']
+        with ThreadPoolExecutor(max_workers=max(1, len(crates))) as executor:
+            futures = [executor.submit(_open_crate, crate) for crate in crates]
+        self.handles = []
+        error = None
+        for future in futures:
+            try:
+                self.handles.append(future.result())
+            except Exception as err:
+                error = error or err
+        if error is not None:
+            # Close the crates that did connect before giving up
+            for handle in self.handles:
+                deinit_system(handle)
+            raise error
 
         try:
-            self.crates_maps = []
-            for handle in self.handles:
-                self.crates_maps.append(get_crate_map(handle))
+            with ThreadPoolExecutor(
+                    max_workers=max(1, len(self.handles))) as executor:
+                self.crates_maps = list(
+                    executor.map(get_crate_map, self.handles))
         except CAENHVError as err:
+            self.crates_maps = []
             print(f"Got error: {err}\nExiting ...")
 
+    def _validate_and_resolve_config(self):
+        """
+        Check the board and bias sections of the config once and resolve every value with the fallback on 'default'.
+        Raises ValueError if a DAQ board is missing a value or uses a crate that is not configured.
+        """
+        nb_crates = len(self.config['crates'])
+        self._resolved = {}
+        self._daqs_by_mode = {}
+        self._board_v = {}
+        self._bias_v0 = {}
+        self._bias_offset = {}
+        for mode in ('board', 'bias'):
+            section = self.config.get(mode, {})
+            default = section.get('default', {})
+            self._daqs_by_mode[mode] = []
+            for daq, prop in section.items():
+                if daq == 'default':
+                    continue
+                crate = _config_value(prop, {}, 'crate', daq, mode)
+                board = _config_value(prop, {}, 'board', daq, mode)
+                channel = _config_value(prop, {}, 'channel', daq, mode)
+                if not 0 <= crate < nb_crates:
+                    raise ValueError(
+                        f"Module {daq} in [{mode}] uses crate {crate}, but only {nb_crates} crates are configured"
+                    )
+                self._resolved[(mode, daq)] = (crate, board, channel)
+                self._daqs_by_mode[mode].append(daq)
+                if mode == 'board':
+                    self._board_v[daq] = _config_value(prop, default, 'v',
+                                                       daq, mode)
+                else:
+                    offset = (_config_value(prop, default, 'v_offset_tofpet',
+                                            daq, mode) +
+                              _config_value(prop, default, 'v_bd', daq, mode))
+                    self._bias_offset[daq] = offset
+                    self._bias_v0[daq] = float(
+                        _config_value(prop, default, 'ov', daq, mode) + offset)
+
+        self._bias_daqs = list(self._bias_offset)
+        self._bias_index = {
+            daq: index
+            for index, daq in enumerate(self._bias_daqs)
+        }
+        self._bias_offsets_arr = np.array(
+            [self._bias_offset[daq] for daq in self._bias_daqs],
+            dtype=np.float64)
+
     def getConfigProperty(self, daq: str, mode: str):
         """
         Get the crate, board and channel number in the config file. daq is the board ('m1x1'...) and mode is either 'board' for LV or 'bias' for HV
         """
-        crate = self.config[mode][daq]['crate']
-        board = self.config[mode][daq]['board']
-        channel = self.config[mode][daq]['channel']
-        return crate, board, channel
+        return self._resolved[(mode, daq)]
+
+    def _iter_daqs(self, mode: str, daqs=None) -> List[str]:
+        """
+        DAQ boards to act on: all the ones of the config if daqs = None, otherwise the given ones that exist in mode.
+        """
+        if daqs is None:
+            return self._daqs_by_mode[mode]
+        selected = []
+        for daq in daqs:
+            if (mode, daq) in self._resolved:
+                selected.append(daq)
+            else:
+                print(f"Module {daq} does not exist")
+        return selected
+
+    def _group_daqs(self, daqs: List[str], mode: str):
+        """
+        Group the DAQ boards by (crate, board).
+        Returns {(crate, board): [(channel, daq), ...]}
+        """
+        grouped: Dict = {}
+        for daq in daqs:
+            crate, board, channel = self.getConfigProperty(daq, mode)
+            grouped.setdefault((crate, board), []).append((channel, daq))
+        return grouped
+
+    def _group_channels(self, daqs: Dict, mode: str):
+        """
+        Group the channels by (crate, board). daqs maps the DAQ board name to the value to set.
+        Returns {(crate, board): [(channel, value), ...]}
+        """
+        return {
+            key: [(channel, daqs[daq]) for channel, daq in chans]
+            for key, chans in self._group_daqs(daqs, mode).items()
+        }
+
+    def _set_grouped(self, parameter: str, daqs: Dict, mode: str,
+                     force=False):
+        """
+        Set the parameter on all the given DAQ boards with one call per board.
+        For the parameters in _CACHED_PARAMETERS, channels already set to the same value by this manager are skipped, unless force = True.
+        The cache only knows what this manager wrote, it goes stale if the value is changed from elsewhere.
+        """
+        cached = parameter in _CACHED_PARAMETERS
+        for (crate, board), chans in self._group_channels(daqs, mode).items():
+            handle = self.handles[crate]
+            if cached and not force:
+                chans = [(ch, value) for ch, value in chans
+                         if self._last_set.get((handle, board, ch,
+                                                parameter)) != value]
+                if not chans:
+                    continue
+            keys = [(handle, board, ch, parameter) for ch, _ in chans]
+            try:
+                set_channel_parameter_list(handle, board,
+                                           [ch for ch, _ in chans], parameter,
+                                           [value for _, value in chans])
+            except CAENHVError:
+                for key in keys:
+                    self._last_set.pop(key, None)
+                raise
+            if cached:
+                for key, (_, value) in zip(keys, chans):
+                    self._last_set[key] = value
 
     def switchLV(self, on: bool, daqs=None):
         """
         Switch on/off the power of the low voltage.
         If daqs = None, it switches on all the DAQ boards, otherwise give an array (['m1x1', 'm1x2',...])
         """
-        if daqs is None:
-            for daq in self.config['board']:
-                if daq != 'default':
-                    crate, board, channel = self.getConfigProperty(
-                        daq, 'board')
-                    set_channel_parameter(self.handles[crate], board, channel,
-                                          'Pw', on)
-        else:
-            for daq in daqs:
-                if daq in self.config['board']:
-                    crate, board, channel = self.getConfigProperty(
-                        daq, 'board')
-                    set_channel_parameter(self.handles[crate], board, channel,
-                                          'Pw', on)
-                else:
-                    print(f"Module {daq} does not exist")
+        self._set_grouped('Pw',
+                          dict.fromkeys(self._iter_daqs('board', daqs),
+                                        int(on)), 'board')
 
     def override_OV(
         self,
         OV: int,
-        daqs=None
+        daqs=None,
+        force=False
     ):  #Give ['m1x1'] or ['m1x1', 'm2x2',....]. None set on all the DAQ boards
         """
         Allows to chose the overvoltage of the different DAQ boards.
         If daq = None, sets the OV on all the DAQ boards, otherwise give an array of strings
+        force = True sends the voltage even if the same value was already set by this manager
         """
         if daqs is None:
-            for daq in self.config['bias']:
-                if daq != 'default':
-                    crate, board, channel = self.getConfigProperty(daq, 'bias')
-                    try:
-                        V = OV + self.config['bias'][daq][
-                            'v_offset_tofpet'] + self.config['bias'][daq][
-                                'v_bd']
-                    except KeyError:
-                        V = OV + self.config['bias']['default'][
-                            'v_offset_tofpet'] + self.config['bias'][daq][
-                                'v_bd']
-                    set_channel_parameter(self.handles[crate], board, channel,
-                                          'V0Set', V)
+            daqs = self._bias_daqs
+            offsets = self._bias_offsets_arr
         else:
-            for daq in daqs:
-                crate, board, channel = self.getConfigProperty(daq, 'bias')
-                try:
-                    V = OV + self.config['bias'][daq][
-                        'v_offset_tofpet'] + self.config['bias'][daq]['v_bd']
-                except KeyError:
-                    V = OV + self.config['bias']['default'][
-                        'v_offset_tofpet'] + self.config['bias'][daq]['v_bd']
-                set_channel_parameter(self.handles[crate], board, channel,
-                                      'V0Set', V)
-
-    def switchHV(self, mode: str, daqs=None):
+            daqs = self._iter_daqs('bias', daqs)
+            indices = np.fromiter((self._bias_index[daq] for daq in daqs),
+                                  dtype=np.intp,
+                                  count=len(daqs))
+            offsets = self._bias_offsets_arr[indices]
+        V = np.add(OV, offsets)
+        self._set_grouped('V0Set', dict(zip(daqs, V.tolist())), 'bias',
+                          force)
+
+    def switchHV(self, mode: str, daqs=None, force=False):
         """
         Switch on/off the power of the High voltage. 4 modes : off = Power off, idle = Power on (OV = -10V), operation = Power on (OV = 3.5V) and on = Power on with the previous set OV
         If daqs = None, it switches on all the DAQ boards, otherwise give an array (['m1x1', 'm1x2',...])
+        force = True sends the voltage even if the same value was already set by this manager
         """
-        if daqs is None:
-            for daq in self.config['bias']:
-                if daq != 'default':
-                    crate, board, channel = self.getConfigProperty(daq, 'bias')
-                    if mode == 'off':
-                        set_channel_parameter(self.handles[crate], board,
-                                              channel, 'Pw', False)
-                    elif mode == 'idle':
-                        self.override_OV(-10, [daq])
-                        set_channel_parameter(self.handles[crate], board,
-                                              channel, 'Pw', True)
-                    elif mode == 'operation':
-                        self.override_OV(self.config['bias']['default']['ov'],
-                                         [daq])
-                        set_channel_parameter(self.handles[crate], board,
-                                              channel, 'Pw', True)
-                    elif mode == 'on':
-                        set_channel_parameter(self.handles[crate], board,
-                                              channel, 'Pw', True)
-        else:
-            for daq in daqs:
-                if daq in self.config['bias']:
-                    crate, board, channel = self.getConfigProperty(daq, 'bias')
-                    if mode == 'off':
-                        set_channel_parameter(self.handles[crate], board,
-                                              channel, 'Pw', False)
-                    elif mode == 'idle':
-                        self.override_OV(-10, [daq])
-                        set_channel_parameter(self.handles[crate], board,
-                                              channel, 'Pw', True)
-                    elif mode == 'operation':
-                        self.override_OV(self.config['bias']['default']['ov'],
-                                         [daq])
-                        set_channel_parameter(self.handles[crate], board,
-                                              channel, 'Pw', True)
-                    elif mode == 'on':
-                        set_channel_parameter(self.handles[crate], board,
-                                              channel, 'Pw', True)
+        selected = self._iter_daqs('bias', daqs)
+        if mode == 'off':
+            self._set_grouped('Pw', dict.fromkeys(selected, 0), 'bias')
+        elif mode == 'idle':
+            self.override_OV(-10, selected, force)
+            self._set_grouped('Pw', dict.fromkeys(selected, 1), 'bias')
+        elif mode == 'operation':
+            self._set_grouped('V0Set',
+                              {daq: self._bias_v0[daq]
+                               for daq in selected}, 'bias', force)
+            self._set_grouped('Pw', dict.fromkeys(selected, 1), 'bias')
+        elif mode == 'on':
+            self._set_grouped('Pw', dict.fromkeys(selected, 1), 'bias')
 
     def showChannelInfo(self, mode: str, daqs=None):
         """
         Print all the parameters of the corresponding channels. If daq = None => print for all boards
         mode is either 'bias' for HV or 'board' for LV
         """
-        if daqs is None:
-            for daq in self.config[mode]:
-                if daq != 'default':
-                    crate, board, channel = self.getConfigProperty(daq, mode)
-                    chan_info = channel_info(self.handles[crate], board,
-                                             channel)
-                    print(f'DAQ {daq} channel information:')
-                    print(
-                        f'crate = {crate}, board = {board}, channel = {channel}'
-                    )
-                    for chan in chan_info:
-                        print(chan)
-                    print('^\n')
-        else:
-            for daq in daqs:
-                crate, board, channel = self.getConfigProperty(daq, mode)
-                chan_info = channel_info(self.handles[crate], board, channel)
-                print(f'DAQ {daq} channel information:')
-                print(f'crate = {crate}, board = {board}, channel = {channel}')
-                for chan in chan_info:
-                    print(chan)
-                print('^\n')
+        for daq in self._iter_daqs(mode, daqs):
+            crate, board, channel = self.getConfigProperty(daq, mode)
+            chan_info = channel_info(self.handles[crate], board, channel)
+            print(f'DAQ {daq} channel information:')
+            print(f'crate = {crate}, board = {board}, channel = {channel}')
+            for chan in chan_info:
+                print(chan)
+            print('^\n')
+
+    def _get_unit(self, crate: int, board: int, channel: int, parameter: str):
+        """
+        Unit of a channel parameter. It does not change while the crate is connected, so it is only asked once.
+        """
+        key = (crate, board, channel, parameter)
+        unit = self._unit_cache.get(key)
+        if unit is None:
+            unit = get_channel_parameter_property(self.handles[crate], board,
+                                                  channel, parameter, 'Unit')
+            self._unit_cache[key] = unit
+        return unit
+
+    def _get_grouped(self, parameter: str, daqs: List[str], mode: str):
+        """
+        Read the parameter on the given DAQ boards with one call per board.
+        Yields (daq, crate, board, channel, value).
+        """
+        for (crate, board), chans in self._group_daqs(daqs, mode).items():
+            values = _get_channel_parameter_multi(self.handles[crate], board,
+                                                  [ch for ch, _ in chans],
+                                                  parameter)
+            for (channel, daq), value in zip(chans, values):
+                yield daq, crate, board, channel, value
 
     def showChannelParameter(self, parameter: str, mode: str, daqs=None):
         """
         Show the chosen parameter for the chosen DAQ boards.
         mode is either 'board' for LV or 'bias' for HV. 
         """
-        if daqs is None:
-            for daq in self.config[mode]:
-                if daq != 'default':
-                    crate, board, channel = self.getConfigProperty(daq, mode)
-                    parameter_value = get_channel_parameter(
-                        self.handles[crate], board, channel, parameter)
-                    parameter_unit = get_channel_parameter_property(
-                        self.handles[crate], board, channel, parameter, 'Unit')
-                    print(
-                        f'DAQ {daq} parameter {parameter} information : {parameter_value} {parameter_unit}'
-                    )
-        else:
-            for daq in daqs:
-                crate, board, channel = self.getConfigProperty(daq, mode)
-                parameter_value = get_channel_parameter(
-                    self.handles[crate], board, channel, parameter)
-                parameter_unit = get_channel_parameter_property(
-                    self.handles[crate], board, channel, parameter, 'Unit')
-                print(
-                    f'DAQ {daq} parameter {parameter} information : {parameter_value} {parameter_unit}'
-                )
+        for daq, crate, board, channel, parameter_value in self._get_grouped(
+                parameter, self._iter_daqs(mode, daqs), mode):
+            parameter_unit = self._get_unit(crate, board, channel, parameter)
+            print(
+                f'DAQ {daq} parameter {parameter} information : {parameter_value} {parameter_unit}'
+            )
 
     def getChannelParameter(self, parameter: str, mode: str, daq: str):
         crate, board, channel = self.getConfigProperty(daq, mode)
@@ -219,34 +368,19 @@ class SndCaenManager():
                                                 channel, parameter)
         return parameter_value
 
-    def setLV(self, v=None, daqs=None):
+    def setLV(self, v=None, daqs=None, force=False):
         """
         Allows to set the LV value to the DAQ boards.
         if v = None => set the default value set in the config fule
         if daqs = None => put it on all boards, otherwise give "['m1x1',...]
+        force = True sends the voltage even if the same value was already set by this manager
         """
-        if daqs is None:
-            for daq in self.config['board']:
-                if daq != 'default':
-                    crate, board, channel = self.getConfigProperty(
-                        daq, 'board')
-                    if v is None:
-                        set_channel_parameter(
-                            self.handles[crate], board, channel, 'V0Set',
-                            self.config['board']['default']['v'])
-                    else:
-                        set_channel_parameter(self.handles[crate], board,
-                                              channel, 'V0Set', v)
+        selected = self._iter_daqs('board', daqs)
+        if v is None:
+            values = {daq: float(self._board_v[daq]) for daq in selected}
         else:
-            for daq in daqs:
-                crate, board, channel = self.getConfigProperty(daq, 'board')
-                if v is None:
-                    set_channel_parameter(self.handles[crate], board, channel,
-                                          'V0Set',
-                                          self.config['board']['default']['v'])
-                else:
-                    set_channel_parameter(self.handles[crate], board, channel,
-                                          'V0Set', v)
+            values = dict.fromkeys(selected, float(v))
+        self._set_grouped('V0Set', values, 'board', force)
 
     def checkStatus(self, mode: str, daqs=None):
         """
@@ -254,23 +388,14 @@ class SndCaenManager():
         mode is either 'board' for LV and 'bias' for HV
         if daqs = None => put it on all boards, otherwise give "['m1x1',...]
         """
-        if daqs is None:
-            for daq in self.config[mode]:
-                if daq != 'default':
-                    crate, board, channel = self.getConfigProperty(daq, mode)
-                    parameter_value = get_channel_parameter(
-                        self.handles[crate], board, channel, 'Status')
-                    if type(parameter_value) == int:
-                        print(f'The board {daq} is working correctly.')
-                        print(parameter_value)
-                    else:
-                        _check_status(parameter_value=parameter_value, daq=daq)
-        else:
-            for daq in daqs:
-                crate, board, channel = self.getConfigProperty(daq, mode)
-                parameter_value = get_channel_parameter(
-                    self.handles[crate], board, channel, 'Status')
-                if type(parameter_value) == int:
-                    print(f'The board {daq} is working correctly.')
-                else:
-                    _check_status(parameter_value=parameter_value, daq=daq)
+        show_value = daqs is None
+        for daq in self._iter_daqs(mode, daqs):
+            crate, board, channel = self.getConfigProperty(daq, mode)
+            parameter_value = get_channel_parameter(self.handles[crate], board,
+                                                    channel, 'Status')
+            if isinstance(parameter_value, (int, np.integer)):
+                print(f'The board {daq} is working correctly.')
+                if show_value:
+                    print(parameter_value)
+            else:
+                _check_status(parameter_value=parameter_value, daq=daq)
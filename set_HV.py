@@ -5,6 +5,7 @@ def main():
     parser = argparse.ArgumentParser('Setting the HV')
     parser.add_argument('mode', type=str, help='Precise the operaton mode (off, idle or operation)')
     parser.add_argument('--daqs', nargs='+', default=None, help='Precise the DAQ boards')
+    parser.add_argument('--force', action='store_true', help='Send the voltage even if it was already set')
     parser.add_argument('--verbose', '-v', action='store_true')
     args = parser.parse_args()
     
@@ -12,10 +13,10 @@ def main():
     manager = SndCaenManager(confPath)
 
     
-    set_HV(args.mode, args.daqs, manager, verbose=args.verbose)
+    set_HV(args.mode, args.daqs, manager, force=args.force, verbose=args.verbose)
 
 def set_HV(mode, daqs, manager: SndCaenManager, **kwargs):
-    manager.switchHV(mode, daqs)
+    manager.switchHV(mode, daqs, force=kwargs.get('force', False))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file